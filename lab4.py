@@ -1,17 +1,32 @@
 
 import os
+import re
+import json
+import hashlib
 import logging
 import asyncio
+import functools
+from collections import deque
 from contextlib import suppress
-from typing import Dict, Optional
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Collection, Dict, Optional, Tuple
 
 import httpx
+import orjson
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils import executor
+from aiogram.utils.exceptions import MessageNotModified
 from dotenv import load_dotenv
+from redis import asyncio as aioredis
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 # ────────────────────────────
 # Инициализация окружения
@@ -26,27 +41,47 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
 )
 logger = logging.getLogger(__name__)
+# httpx пишет INFO на каждый запрос — в горячем пути это лишнее
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # ────────────────────────────
 # Конфигурация приложения
 # ────────────────────────────
+@dataclass(frozen=True, slots=True)
 class Config:
     """Класс для работы с конфигурацией приложения"""
 
-    def __init__(self) -> None:
-        self.API_TOKEN = self._get_env_var("TELEGRAM_API_TOKEN")
-        self.YANDEX_GPT_API_KEY = self._get_env_var("YANDEX_GPT_API_KEY")
-        self.YANDEX_FOLDER_ID = self._get_env_var("YANDEX_FOLDER_ID")
-        self.HYPERBOLIC_API_KEY = self._get_env_var("HYPERBOLIC_API_KEY")
-
-    @staticmethod
-    def _get_env_var(name: str) -> str:
-        """Получение переменной окружения с валидацией"""
-        value = os.getenv(name)
-        if not value:
-            logger.error("❌ Отсутствует обязательная переменная окружения: %s", name)
-            exit(1)
-        return value
+    API_TOKEN: str
+    YANDEX_GPT_API_KEY: str
+    YANDEX_FOLDER_ID: str
+    HYPERBOLIC_API_KEY: str
+    # необязательно: публичный https‑адрес для вебхука (без него — long polling)
+    WEBHOOK_HOST: Optional[str] = None
+    WEBAPP_PORT: int = 8080
+    # Redis для FSM и кэша ответов моделей
+    REDIS_HOST: str = "localhost"
+    REDIS_PORT: int = 6379
+
+    _REQUIRED = ("TELEGRAM_API_TOKEN", "YANDEX_GPT_API_KEY", "YANDEX_FOLDER_ID", "HYPERBOLIC_API_KEY")
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        """Чтение переменных окружения; все пропуски сообщаются одной ошибкой"""
+        missing = [name for name in cls._REQUIRED if not os.getenv(name)]
+        if missing:
+            logger.error("❌ Отсутствуют обязательные переменные окружения: %s", ", ".join(missing))
+            raise SystemExit(1)
+
+        return cls(
+            API_TOKEN=os.environ["TELEGRAM_API_TOKEN"],
+            YANDEX_GPT_API_KEY=os.environ["YANDEX_GPT_API_KEY"],
+            YANDEX_FOLDER_ID=os.environ["YANDEX_FOLDER_ID"],
+            HYPERBOLIC_API_KEY=os.environ["HYPERBOLIC_API_KEY"],
+            WEBHOOK_HOST=os.getenv("WEBHOOK_HOST"),
+            WEBAPP_PORT=int(os.getenv("WEBAPP_PORT", "8080")),
+            REDIS_HOST=os.getenv("REDIS_HOST", "localhost"),
+            REDIS_PORT=int(os.getenv("REDIS_PORT", "6379")),
+        )
 
 
 # ────────────────────────────
@@ -61,107 +96,237 @@ class Form(StatesGroup):
 
 
 # ────────────────────────────
-# Базовый HTTP‑клиент
+# Повторы запросов к моделям
 # ────────────────────────────
-class APIClient:
-    """Базовый класс для API‑клиентов"""
+def _is_retryable(exc: BaseException) -> bool:
+    """Сетевые сбои, 429 и 5xx повторяем; прочие 4xx (ключ, payload) — нет"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, httpx.TransportError)
 
-    def __init__(self, timeout: int = 30) -> None:
-        # глобальный тайм‑аут для всех запросов
-        self.client = httpx.AsyncClient(timeout=timeout)
 
-    async def __aenter__(self):
-        return self
+_backoff = wait_random_exponential(multiplier=0.5, max=5)
 
-    async def __aexit__(self, *args):
-        await self.client.aclose()
+
+def _retry_wait(retry_state) -> float:
+    """Экспоненциальная пауза с джиттером; на 429 уважаем Retry-After"""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 30.0)
+    return _backoff(retry_state)
+
+
+_RETRY_POLICY = dict(
+    stop=stop_after_attempt(3),
+    wait=_retry_wait,
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
 
 
 # ────────────────────────────
 # YandexGPT
 # ────────────────────────────
-class YandexGPTClient(APIClient):
-    BASE_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+# колбэк потоковой генерации: получает весь накопленный на данный момент текст
+OnChunk = Callable[[str], Awaitable[None]]
+
+YANDEX_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+
+# неизменяемые части payload собираются один раз
+_YANDEX_OPTS = {"stream": True, "temperature": 0.7, "maxTokens": 1500}
+_YANDEX_SYSTEM_MSG = {
+    "role": "system",
+    "text": "Ты карьерный консультант. Составь детальный персонализированный роадмап.",
+}
+
+# поля анкеты в порядке вопросов и бюджет символов на каждое в промпте
+# (длина промпта напрямую влияет на латентность модели) — единственный
+# источник списка полей для промпта, формы и ключа кэша
+_FIELD_LIMITS = (
+    ("profession", 80),
+    ("experience", 60),
+    ("goals", 400),
+    ("skills", 400),
+    ("preferences", 200),
+)
+_FIELDS = tuple(name for name, _ in _FIELD_LIMITS)
+_MAX_FIELD_CHARS = dict(_FIELD_LIMITS)
+
+# шаблон разбирается один раз при загрузке модуля
+_PROMPT_TMPL = (
+    "Составь детальный карьерный роадмап для профессии {profession}. "
+    "Учитывая что у пользователя текущий опыт: {experience}, "
+    "карьерные цели: {goals}, текущие навыки: {skills}, "
+    "и предпочтения: {preferences}. Включи:\n"
+    "1. Поэтапный план развития\n2. Рекомендуемые обучающие ресурсы\n"
+    "3. Ключевые навыки для развития\n4. Рекомендации по нетворкингу\n"
+    "5. Потенциальные карьерные треки"
+)
 
-    def __init__(self, api_key: str, folder_id: str, timeout: int = 30) -> None:
-        super().__init__(timeout)
-        self.headers = {
-            "Authorization": f"Api-Key {api_key}",
-            "Content-Type": "application/json",
-        }
-        self.model_uri = f"gpt://{folder_id}/yandexgpt-lite"
-
-    async def generate_roadmap(self, user_data: Dict[str, str]) -> Optional[str]:
-        payload = {
-            "modelUri": self.model_uri,
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.7,
-                "maxTokens": 1500,
-            },
-            "messages": [
-                {
-                    "role": "system",
-                    "text": "Ты карьерный консультант. Составь детальный персонализированный роадмап.",
-                },
-                {"role": "user", "text": self._build_prompt(user_data)},
-            ],
-        }
 
-        try:
-            response = await self.client.post(
-                self.BASE_URL, headers=self.headers, json=payload
-            )
-            response.raise_for_status()
-            return response.json()["result"]["alternatives"][0]["message"]["text"]
-        except Exception as exc:  # noqa: BLE001
-            logger.error("YandexGPT Error: %s", exc, exc_info=True)
-            return None
+# ответы нормализуются один раз при сохранении в FSM
+_WS_RE = re.compile(r"\s+")
+_MAX_ANSWER_LEN = 512
 
-    @staticmethod
-    def _build_prompt(data: Dict[str, str]) -> str:
-        """Формирование промпта с безопасным доступом к ключам"""
-        return (
-            f"Составь детальный карьерный роадмап для профессии {data.get('profession', '-')}. "
-            f"Учитывая что у пользователя текущий опыт: {data.get('experience', '-')}, "
-            f"карьерные цели: {data.get('goals', '-')}, текущие навыки: {data.get('skills', '-')}, "
-            f"и предпочтения: {data.get('preferences', '-')}. Включи:\n"
-            "1. Поэтапный план развития\n2. Рекомендуемые обучающие ресурсы\n"
-            "3. Ключевые навыки для развития\n4. Рекомендации по нетворкингу\n"
-            "5. Потенциальные карьерные треки"
-        )
+
+def clean_answer(text: str) -> str:
+    """Обрезка пробелов по краям, схлопывание внутренних и ограничение длины"""
+    return _WS_RE.sub(" ", text.strip())[:_MAX_ANSWER_LEN]
+
+
+def prompt_fields(data: Dict[str, str]) -> Dict[str, str]:
+    """Значения полей ровно в том виде, в каком они попадут в промпт"""
+    return {k: (data.get(k) or "-")[: _MAX_FIELD_CHARS[k]] for k in _FIELDS}
+
+
+def build_prompt(data: Dict[str, str]) -> str:
+    """Формирование промпта с безопасным доступом к ключам"""
+    for key in _FIELDS:
+        length, limit = len(data.get(key) or ""), _MAX_FIELD_CHARS[key]
+        if length > limit:
+            logger.info("Поле %s обрезано для промпта: %d → %d символов", key, length, limit)
+    return _PROMPT_TMPL.format_map(prompt_fields(data))
+
+
+async def call_yandex(
+    http: httpx.AsyncClient,
+    headers: Dict[str, str],
+    model_uri: str,
+    user_data: Dict[str, str],
+    prompt: Optional[str] = None,
+    on_chunk: Optional[OnChunk] = None,
+) -> Optional[str]:
+    if prompt is None:
+        prompt = build_prompt(user_data)
+    payload = {
+        "modelUri": model_uri,
+        "completionOptions": _YANDEX_OPTS,
+        "messages": [_YANDEX_SYSTEM_MSG, {"role": "user", "text": prompt}],
+    }
+
+    try:
+        async for attempt in AsyncRetrying(**_RETRY_POLICY):
+            with attempt:
+                text = None
+                async with http.stream(
+                    "POST", YANDEX_URL, headers=headers, content=orjson.dumps(payload)
+                ) as response:
+                    response.raise_for_status()
+                    logger.debug("YandexGPT: %s", response.http_version)
+                    # каждая строка — JSON с полным текстом, сгенерированным к этому моменту
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        text = orjson.loads(line)["result"]["alternatives"][0]["message"]["text"]
+                        if on_chunk is not None:
+                            await on_chunk(text)
+                return text
+    except httpx.HTTPStatusError as exc:
+        # ожидаемые отказы API (4xx/429/5xx) — без дорогого форматирования трейсбека
+        logger.warning("YandexGPT Error: %s %s", exc.response.status_code, exc.request.url)
+        return None
+    except httpx.TransportError as exc:
+        logger.warning("YandexGPT Error: %s: %s", type(exc).__name__, exc)
+        return None
+    except Exception as exc:  # noqa: BLE001
+        logger.error("YandexGPT Error: %s", exc, exc_info=True)
+        return None
 
 
 # ────────────────────────────
 # Hyperbolic (Llama‑3.3‑70B‑Instruct)
 # ────────────────────────────
-class HyperbolicClient(APIClient):
-    BASE_URL = "https://api.hyperbolic.xyz/v1/chat/completions"
+HYPERBOLIC_URL = "https://api.hyperbolic.xyz/v1/chat/completions"
+
+_HYPERBOLIC_OPTS = {
+    "model": "meta-llama/Llama-3.3-70B-Instruct",
+    "max_tokens": 512,
+    "temperature": 0.1,
+    "top_p": 0.9,
+    "stream": True,
+}
+
+
+async def call_hyperbolic(
+    http: httpx.AsyncClient,
+    headers: Dict[str, str],
+    prompt: str,
+    on_chunk: Optional[OnChunk] = None,
+) -> Optional[str]:
+    payload = {"messages": [{"role": "user", "content": prompt}], **_HYPERBOLIC_OPTS}
+    try:
+        async for attempt in AsyncRetrying(**_RETRY_POLICY):
+            with attempt:
+                parts = []
+                async with http.stream(
+                    "POST", HYPERBOLIC_URL, headers=headers, content=orjson.dumps(payload)
+                ) as response:
+                    response.raise_for_status()
+                    logger.debug("Hyperbolic API: %s", response.http_version)
+                    # SSE в формате OpenAI: "data: {...}" с дельтами, в конце "data: [DONE]"
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = orjson.loads(data).get("choices")
+                        delta = choices[0].get("delta", {}).get("content") if choices else None
+                        if delta:
+                            parts.append(delta)
+                            if on_chunk is not None:
+                                await on_chunk("".join(parts))
+                return "".join(parts) or None
+    except httpx.HTTPStatusError as exc:
+        # ожидаемые отказы API (4xx/429/5xx) — без дорогого форматирования трейсбека
+        logger.warning("Hyperbolic API Error: %s %s", exc.response.status_code, exc.request.url)
+        return None
+    except httpx.TransportError as exc:
+        logger.warning("Hyperbolic API Error: %s: %s", type(exc).__name__, exc)
+        return None
+    except Exception as exc:  # noqa: BLE001
+        logger.error("Hyperbolic API Error: %s", exc, exc_info=True)
+        return None
 
-    def __init__(self, api_key: str, timeout: int = 30) -> None:
-        super().__init__(timeout)
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        }
 
-    async def generate_analysis(self, prompt: str) -> Optional[str]:
-        payload = {
-            "messages": [{"role": "user", "content": prompt}],
-            "model": "meta-llama/Llama-3.3-70B-Instruct",
-            "max_tokens": 512,
-            "temperature": 0.1,
-            "top_p": 0.9,
-        }
-        try:
-            response = await self.client.post(
-                self.BASE_URL, headers=self.headers, json=payload
-            )
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
-        except Exception as exc:  # noqa: BLE001
-            logger.error("Hyperbolic API Error: %s", exc, exc_info=True)
-            return None
+# ────────────────────────────
+# Ограничение частоты отправки
+# ────────────────────────────
+class RateLimiter:
+    """Не более `rate` входов за `period` секунд (скользящее окно)"""
+
+    def __init__(self, rate: int, period: float) -> None:
+        self.rate = rate
+        self.period = period
+        self._stamps: deque = deque()
+        self._lock = asyncio.Lock()
+
+    @property
+    def idle(self) -> bool:
+        loop = asyncio.get_running_loop()
+        return not self._stamps or self._stamps[-1] <= loop.time() - self.period
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                while self._stamps and self._stamps[0] <= now - self.period:
+                    self._stamps.popleft()
+                if len(self._stamps) < self.rate:
+                    break
+                await asyncio.sleep(self._stamps[0] + self.period - now)
+            self._stamps.append(now)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        return None
 
 
 # ────────────────────────────
@@ -170,14 +335,11 @@ class HyperbolicClient(APIClient):
 class RoadmapGeneratorBot:
     """Бот, объединяющий обе модели"""
 
-    # порядок вопросов (строки, а не State‑объекты)
-    _STATE_ORDER = [
-        "profession",
-        "experience",
-        "goals",
-        "skills",
-        "preferences",
-    ]
+    # таблица переходов формы: текущий шаг → следующий (None — анкета заполнена)
+    _NEXT: Dict[str, Optional[str]] = dict(zip(_FIELDS, _FIELDS[1:] + (None,)))
+    _FORMS: Dict[str, State] = {name: getattr(Form, name) for name in _FIELDS}
+    # строка состояния из FSM (напр. 'Form:profession') → ключ поля
+    _STATE_KEYS: Dict[str, str] = {form.state: name for name, form in _FORMS.items()}
 
     _QUESTIONS = {
         "profession": "📌 Назовите профессию или должность, для которой хотите получить роадмап:",
@@ -187,109 +349,403 @@ class RoadmapGeneratorBot:
         "preferences": "🌟 Есть ли особые предпочтения или ограничения?\n(удаленная работа, индустрия и т.д.)",
     }
 
+    # кэш готовых ответов моделей (сутки)
+    _CACHE_PREFIX = "roadmap:"
+    _CACHE_TTL = 86400
+
+    # число фоновых воркеров, параллельно обращающихся к моделям
+    _NUM_WORKERS = 8
+    _SHUTDOWN_TEXT = "⚠️ Бот перезапускается, роадмап не был сгенерирован. Начните заново с /start"
+
+    # как часто (сек) обновлять сообщение с частичным ответом (только в личных чатах)
+    _EDIT_INTERVAL = 1.0
+
+    # сколько (сек) максимум ждём обе модели вместе
+    _MODELS_TIMEOUT = 120
+
+    # лимиты Telegram: 30 сообщений/с всего и 20 сообщений/мин в группу
+    _GROUP_LIMITERS_MAX = 10000
+
     def __init__(self, config: Config) -> None:
+        self.config = config
         self.bot = Bot(token=config.API_TOKEN)
-        self.dp = Dispatcher(self.bot, storage=MemoryStorage())
-        self.yandex_client = YandexGPTClient(
-            config.YANDEX_GPT_API_KEY, config.YANDEX_FOLDER_ID
+        # неугадываемый путь вебхука: без него любой, кто знает хост, может слать
+        # поддельные апдейты и запускать платные вызовы моделей
+        self.webhook_path = "/tg/" + hashlib.sha256(config.API_TOKEN.encode()).hexdigest()
+        # FSM в Redis: состояние переживает рестарт и общее для нескольких воркеров
+        self.storage = RedisStorage2(
+            host=config.REDIS_HOST,
+            port=config.REDIS_PORT,
+            db=0,
+            pool_size=20,
+            prefix="roadmap_fsm",
+            state_ttl=3600,
+            data_ttl=3600,
         )
-        self.hyperbolic_client = HyperbolicClient(config.HYPERBOLIC_API_KEY)
+        self.dp = Dispatcher(self.bot, storage=self.storage)
+        # отдельный клиент для кэша ответов: storage.redis() устарел в aiogram 2.25
+        self.redis = aioredis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=0)
+
+        # один пул keep‑alive соединений (HTTP/2) на оба LLM‑эндпоинта;
+        # клиенты моделей — функции без состояния, получающие его аргументом
+        # раздельные тайм‑ауты: быстро падаем на connect/pool, read — между чанками стрима;
+        # accept-encoding не задаём вручную: httpx сам объявляет gzip/deflate
+        # и br (при установленном brotli) — ровно те кодировки, что умеет распаковать
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(read=25, write=5, connect=3, pool=2),
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+            http2=True,
+        )
+        self.yandex_headers = {
+            "Authorization": f"Api-Key {config.YANDEX_GPT_API_KEY}",
+            "Content-Type": "application/json",
+        }
+        self.yandex_model_uri = f"gpt://{config.YANDEX_FOLDER_ID}/yandexgpt-lite"
+        self.hyperbolic_headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {config.HYPERBOLIC_API_KEY}",
+        }
+
+        # очередь заданий на генерацию: (chat_id, ответы анкеты)
+        self.jobs: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self._workers = []
+        # генерации в процессе, по ключу кэша (single‑flight)
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        # предварительный троттлинг исходящих сообщений вместо ретраев на 429
+        self._all_limiter = RateLimiter(30, 1)
+        self._group_limiters: Dict[int, RateLimiter] = {}
 
         # регистрация хэндлеров
         self.dp.register_message_handler(self.start_command, commands=["start"], state="*")
         self.dp.register_message_handler(
             self.process_answer,
-            state=[
-                Form.profession,
-                Form.experience,
-                Form.goals,
-                Form.skills,
-                Form.preferences,
-            ],
+            state=list(self._FORMS.values()),
         )
 
     # ── Handlers ────────────────────────────── #
     async def start_command(self, message: types.Message):
-        await message.answer(
+        await self._send(
+            message.chat.id,
             "🌟 Добро пожаловать в CareerRoadmapBot!\n"
             "Я помогу составить персонализированный карьерный план развития.\n"
-            "Ответьте на несколько вопросов для начала:"
+            "Ответьте на несколько вопросов для начала:",
         )
-        await self._ask_question(message, Form.profession)
+        await self._ask_question(message, "profession")
 
-    async def _ask_question(self, message: types.Message, state: State):
-        await state.set()
-        await message.answer(self._QUESTIONS[state.state.split(":")[1]])
+    async def _ask_question(self, message: types.Message, state_name: str):
+        await self._FORMS[state_name].set()
+        await self._send(message.chat.id, self._QUESTIONS[state_name])
 
     async def process_answer(self, message: types.Message, state: FSMContext):
         """Обрабатывает ответ пользователя и двигает форму дальше"""
-        current_state_full = await state.get_state()  # напр. 'Form:profession'
-        if not current_state_full:
+        state_name = self._STATE_KEYS.get(await state.get_state())
+        if not state_name:
             return
 
-        state_name = current_state_full.split(":")[1]
         async with state.proxy() as data:
-            data[state_name] = message.text.strip()
-
-        # определить следующее состояние
-        try:
-            idx = self._STATE_ORDER.index(state_name)
-            next_state_name = self._STATE_ORDER[idx + 1] if idx + 1 < len(self._STATE_ORDER) else None
-        except ValueError:
-            next_state_name = None
+            data[state_name] = clean_answer(message.text)
 
+        next_state_name = self._NEXT.get(state_name)
         if next_state_name:
-            await self._ask_question(message, getattr(Form, next_state_name))
+            await self._ask_question(message, next_state_name)
         else:
             await self._generate_and_send_roadmap(message, state)
 
     # ── Генерация роадмапа ───────────────────── #
     async def _generate_and_send_roadmap(self, message: types.Message, state: FSMContext):
-        await message.answer("🔍 Анализирую данные... Это займет 1‑2 минуты")
-
+        await self._send(message.chat.id, "🔍 Анализирую данные... Это займет 1‑2 минуты")
+
+        # сама генерация идёт в фоновых воркерах, хэндлер возвращается сразу
+        await self.jobs.put((message.chat.id, await state.get_data()))
+        await state.finish()
+
+    async def _worker(self):
+        while True:
+            chat_id, user_data = await self.jobs.get()
+            try:
+                await self._do_generate(chat_id, user_data)
+            finally:
+                self.jobs.task_done()
+
+    async def _do_generate(self, chat_id: int, user_data: Dict[str, str]):
+        live: Dict[str, Optional[str]] = {"yandex": None, "hyperbolic": None}
+        finished = set()
+        changed = asyncio.Event()
+        updating = asyncio.Lock()
+        sent: Optional[types.Message] = None
+
+        async def on_chunk(source: str, text: Optional[str], force: bool = False):
+            """Только запоминает частичный ответ: стрим модели не ждёт Telegram;
+            force — модель закончила, её ответ (или ошибку) показываем как есть"""
+            if force:
+                finished.add(source)
+                live[source] = text
+            elif text:
+                live[source] = text
+            changed.set()
+
+        async def refresh():
+            """Отдельная задача обновляет превью не чаще _EDIT_INTERVAL"""
+            nonlocal sent
+            while True:
+                await changed.wait()
+                changed.clear()
+                async with updating:
+                    # промежуточный текст без Markdown: незакрытая разметка ломает парсинг
+                    preview = self._format_responses(
+                        live["yandex"], live["hyperbolic"], pending=True, finished=finished
+                    )
+                    with suppress(Exception):
+                        if sent is None:
+                            sent = await self._send(chat_id, preview)
+                        else:
+                            await self._edit(sent, preview)
+                await asyncio.sleep(self._EDIT_INTERVAL)
+
+        # в группах живое превью съело бы общий лимит 20 сообщений/мин
+        refresher = asyncio.create_task(refresh()) if chat_id > 0 else None
         try:
-            user_data = await state.get_data()
-            base_prompt = YandexGPTClient._build_prompt(user_data)
-
-            yandex_resp, hyperbolic_resp = await asyncio.gather(
-                self.yandex_client.generate_roadmap(user_data),
-                self.hyperbolic_client.generate_analysis(
-                    f"Дай дополнительные рекомендации для этого запроса: {base_prompt}"
-                ),
-            )
-
-            await message.answer(self._format_responses(yandex_resp, hyperbolic_resp), parse_mode="Markdown")
+            try:
+                yandex_resp, hyperbolic_resp = await self._generate(
+                    user_data, on_chunk if refresher else None
+                )
+            finally:
+                if refresher:
+                    # не прерываем отправку на полпути, иначе превью задублируется
+                    async with updating:
+                        refresher.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await refresher
+
+            text = self._format_responses(yandex_resp, hyperbolic_resp)
+            if sent is None:
+                await self._send(chat_id, text, parse_mode="Markdown")
+            else:
+                await self._edit(sent, text, parse_mode="Markdown")
+        except asyncio.CancelledError:
+            # остановка бота: роадмапа не будет, «Готово» здесь вводило бы в заблуждение
+            with suppress(Exception):
+                await self._send(chat_id, self._SHUTDOWN_TEXT)
+            raise
         except Exception as exc:  # noqa: BLE001
             logger.error("Ошибка генерации: %s", exc, exc_info=True)
-            await message.answer("⚠️ Произошла ошибка при генерации роадмапа")
-        finally:
             with suppress(Exception):
-                await state.finish()
-                await message.answer(
-                    "✅ Готово! Можете начать заново с /start"
+                await self._send(chat_id, "⚠️ Произошла ошибка при генерации роадмапа")
+
+        with suppress(Exception):
+            await self._send(chat_id, "✅ Готово! Можете начать заново с /start")
+
+    async def _generate(
+        self,
+        user_data: Dict[str, str],
+        on_chunk: Optional[Callable[..., Awaitable[None]]] = None,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """Ответы обеих моделей; одинаковые анкеты берутся из кэша в Redis"""
+        key = self._CACHE_PREFIX + self._cache_key(user_data)
+        with suppress(Exception):
+            cached = await self.redis.get(key)
+            if cached:
+                hit = json.loads(cached)
+                return hit["yandex"], hit["hyperbolic"]
+
+        # одинаковая анкета уже генерируется — ждём её результат вместо второго вызова
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        result: Tuple[Optional[str], Optional[str]] = (None, None)
+        try:
+            result = await self._call_models(user_data, on_chunk)
+
+            # неудачные ответы не кэшируем, чтобы следующий запрос повторил попытку;
+            # ключ снимаем только после записи в кэш, иначе запрос в этом окне
+            # промахнётся мимо обоих и снова вызовет модели
+            yandex_resp, hyperbolic_resp = result
+            if yandex_resp and hyperbolic_resp:
+                with suppress(Exception):
+                    await self.redis.setex(
+                        key,
+                        self._CACHE_TTL,
+                        json.dumps({"yandex": yandex_resp, "hyperbolic": hyperbolic_resp}),
+                    )
+        finally:
+            del self._inflight[key]
+            fut.set_result(result)
+        return result
+
+    async def _call_models(
+        self,
+        user_data: Dict[str, str],
+        on_chunk: Optional[Callable[..., Awaitable[None]]] = None,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        def bind(source: str) -> Optional[OnChunk]:
+            return functools.partial(on_chunk, source) if on_chunk else None
+
+        base_prompt = build_prompt(user_data)
+        tasks = {
+            asyncio.create_task(
+                call_yandex(
+                    self.http,
+                    self.yandex_headers,
+                    self.yandex_model_uri,
+                    user_data,
+                    base_prompt,
+                    bind("yandex"),
+                )
+            ): "yandex",
+            asyncio.create_task(
+                call_hyperbolic(
+                    self.http,
+                    self.hyperbolic_headers,
+                    f"Дай дополнительные рекомендации для этого запроса: {base_prompt}",
+                    bind("hyperbolic"),
+                )
+            ): "hyperbolic",
+        }
+        results: Dict[str, Optional[str]] = {"yandex": None, "hyperbolic": None}
+
+        # ответ каждой модели показываем, как только он готов; медленную модель
+        # ждём не дольше общего дедлайна и отдаём пользователю то, что успело прийти
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._MODELS_TIMEOUT
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED
                 )
+                if not done:
+                    logger.warning(
+                        "Модели не ответили за %s с: %s",
+                        self._MODELS_TIMEOUT,
+                        ", ".join(tasks[t] for t in pending),
+                    )
+                    break
+                for task in done:
+                    source = tasks[task]
+                    results[source] = task.result()
+                    if on_chunk and pending:
+                        await on_chunk(source, results[source], force=True)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        return results["yandex"], results["hyperbolic"]
 
     @staticmethod
-    def _format_responses(yandex: Optional[str], hyperbolic: Optional[str]) -> str:
-        def safe(text: Optional[str], default: str) -> str:
-            return text.strip() if text else default
+    def _cache_key(user_data: Dict[str, str]) -> str:
+        # ключ — от тех же обрезанных значений, что уходят в промпт: одинаковый
+        # промпт даёт одинаковый ключ; ответы уже очищены clean_answer
+        normalized = {k: v.casefold() for k, v in prompt_fields(user_data).items()}
+        return hashlib.blake2b(
+            json.dumps(normalized, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
+
+    # ── Отправка сообщений ──────────────────── #
+    async def _send(self, chat_id: int, text: str, **kwargs) -> types.Message:
+        """Все исходящие сообщения проходят через лимиты Telegram"""
+        if chat_id < 0:  # группы и каналы
+            await self._group_limiter(chat_id).acquire()
+        async with self._all_limiter:
+            return await self.bot.send_message(chat_id, text, **kwargs)
+
+    async def _edit(self, message: types.Message, text: str, **kwargs):
+        chat_id = message.chat.id
+        if chat_id < 0:  # правки в группе считаются в тот же лимит 20/мин
+            await self._group_limiter(chat_id).acquire()
+        async with self._all_limiter:
+            with suppress(MessageNotModified):
+                await message.edit_text(text, **kwargs)
+
+    def _group_limiter(self, chat_id: int) -> RateLimiter:
+        limiter = self._group_limiters.get(chat_id)
+        if limiter is None:
+            if len(self._group_limiters) >= self._GROUP_LIMITERS_MAX:
+                self._group_limiters = {
+                    k: v for k, v in self._group_limiters.items() if not v.idle
+                }
+            limiter = self._group_limiters[chat_id] = RateLimiter(20, 60)
+        return limiter
 
+    @staticmethod
+    def _format_responses(
+        yandex: Optional[str],
+        hyperbolic: Optional[str],
+        pending: bool = False,
+        finished: Collection[str] = (),
+    ) -> str:
+        def safe(source: str, text: Optional[str], default: str) -> str:
+            if text:
+                return text.strip()
+            # пока модель не закончила, показываем ожидание, а не ошибку
+            return "⏳ Генерируется…" if pending and source not in finished else default
+
+        # превью уходит без parse_mode — там звёздочки были бы видны как есть
+        bold = "" if pending else "**"
         return (
-            "🚀 **Основной роадмап от YandexGPT:**\n\n" + safe(yandex, "Не удалось получить основной роадмап") + "\n\n" +
-            "🔍 **Дополнительные рекомендации от Llama‑3:**\n\n" + safe(hyperbolic, "Не удалось получить дополнительные рекомендации")
+            f"🚀 {bold}Основной роадмап от YandexGPT:{bold}\n\n" + safe("yandex", yandex, "Не удалось получить основной роадмап") + "\n\n" +
+            f"🔍 {bold}Дополнительные рекомендации от Llama‑3:{bold}\n\n" + safe("hyperbolic", hyperbolic, "Не удалось получить дополнительные рекомендации")
         )
 
+    # ── Жизненный цикл ───────────────────────── #
+    async def _on_startup(self, dp: Dispatcher):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._NUM_WORKERS)]
+        if self.config.WEBHOOK_HOST:
+            await self.bot.set_webhook(self.config.WEBHOOK_HOST + self.webhook_path)
+
+    async def _on_shutdown(self, dp: Dispatcher):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        # задания, до которых воркеры не дошли: пользователь уже видел «Анализирую…»
+        while not self.jobs.empty():
+            chat_id, _ = self.jobs.get_nowait()
+            self.jobs.task_done()
+            with suppress(Exception):
+                await self._send(chat_id, self._SHUTDOWN_TEXT)
+        await self.http.aclose()
+        await self.redis.aclose()
+        await self.storage.close()
+        await self.storage.wait_closed()
+
     # ── Запуск ───────────────────────────────── #
     def run(self):
         logger.info("Запуск бота…")
-        executor.start_polling(self.dp, skip_updates=True)
+        if self.config.WEBHOOK_HOST:
+            # апдейты приходят push‑запросами, хэндлер отвечает сразу (генерация — в очереди)
+            executor.start_webhook(
+                self.dp,
+                webhook_path=self.webhook_path,
+                on_startup=self._on_startup,
+                on_shutdown=self._on_shutdown,
+                skip_updates=True,
+                host="0.0.0.0",
+                port=self.config.WEBAPP_PORT,
+            )
+            return
+        executor.start_polling(
+            self.dp,
+            skip_updates=True,
+            on_startup=self._on_startup,
+            on_shutdown=self._on_shutdown,
+        )
 
 
 # ────────────────────────────
 # Entry point
 # ────────────────────────────
 if __name__ == "__main__":
-    cfg = Config()
+    # uvloop (libuv) быстрее стандартного цикла; ставим до создания бота,
+    # чтобы executor подхватил его. На Windows его нет — остаёмся на asyncio
+    with suppress(ImportError):
+        import uvloop
+
+        uvloop.install()
+
+    cfg = Config.from_env()
     RoadmapGeneratorBot(cfg).run()
 
 